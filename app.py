@@ -1,38 +1,199 @@
-from flask import Flask, request, render_template, jsonify, redirect, url_for, send_from_directory
+# Patch blocking I/O first so concurrent uploads' OpenAI calls can overlap
+from gevent import monkey
+monkey.patch_all()
+import gevent.threadpool
+
+from flask import Flask, request, render_template, jsonify, redirect, url_for, send_from_directory, abort
 import os
-import base64
-from werkzeug.utils import secure_filename
-import requests
+import sys
+import importlib
+import hmac
+import hashlib
+import time
+try:
+    # SIMD-accelerated base64; fall back to the standard library if unavailable
+    import pybase64 as base64
+except ImportError:
+    import base64
+# httpcore probes for the optional trio package and expects ImportError if it
+# is missing. After select is monkey-patched (by us, or by gunicorn's gevent
+# worker before it imports this module) an installed trio fails with
+# AttributeError on select.epoll instead, so mark it unavailable; only the
+# sync client is used here. A missing trio is the normal case and needs nothing
+try:
+    importlib.import_module('trio')
+except ImportError:
+    pass
+except AttributeError:
+    sys.modules['trio'] = None
+import httpx
+# Serializes request bodies carrying multi-MB base64 images much faster than json
+import orjson
+import io
 import json
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['JOBS_FOLDER'] = 'jobs'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Create uploads directory if it doesn't exist
+# Create uploads and jobs directories if they don't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOBS_FOLDER'], exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
+# Leading bytes of each allowed image format
+IMAGE_SIGNATURES = (
+    b"\x89PNG\r\n\x1a\n",  # png
+    b"\xff\xd8\xff",  # jpg/jpeg
+    b"GIF87a",  # gif
+    b"GIF89a",  # gif
+)
+
+# When set, OpenAI fetches uploads from this public URL instead of receiving
+# the image inline as base64; upload URLs are then HMAC-signed and expire
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+UPLOAD_URL_TTL = 3600  # seconds
+UPLOAD_MAX_AGE = 86400  # browser cache lifetime for uploaded images, in seconds
+# Every worker process must sign with the same key, or a URL signed by one
+# worker is rejected by another
+URL_SIGNING_KEY = os.environ.get('SECRET_KEY', '').encode()
+if PUBLIC_BASE_URL and not URL_SIGNING_KEY:
+    raise RuntimeError("SECRET_KEY environment variable is required when PUBLIC_BASE_URL is set")
+
+# The API key is mandatory, so fail at startup rather than on every upload
+API_KEY = os.environ.get('OPENAI_API_KEY')
+if not API_KEY:
+    raise RuntimeError("OPENAI_API_KEY environment variable is required")
+AUTH_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {API_KEY}"
+}
+
+# Vision-capable model used for classification and feedback
+VISION_MODEL = "gpt-4o"
+
+# Fail fast on an unreachable host but allow slow model responses
+OPENAI_TIMEOUT = httpx.Timeout(30.0, connect=3.05)
+
+# Shared HTTP/2 client so concurrent OpenAI calls are multiplexed over
+# kept-alive connections. Only failed connection attempts are retried: both
+# OpenAI calls are non-idempotent POSTs, so error statuses are not retried
+CLIENT = httpx.Client(
+    timeout=OPENAI_TIMEOUT,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=20)
+    )
+)
+
+# Background workers for analysis jobs, so uploads don't hold a request
+# open for the whole OpenAI round trip
+executor = ThreadPoolExecutor(max_workers=16)
+
+# Jobs only live in the worker process that queued them, so one that is
+# still pending after this long was lost (e.g. to a restart) and is failed
+JOB_TIMEOUT = 300  # seconds
+
+# Oldest files beyond these counts are deleted so disk usage stays bounded
+MAX_UPLOADS = 500
+MAX_JOBS = 500
+eviction_lock = threading.Lock()
+
+# Native OS threads (not greenlets) for disk writes and CPU-bound image
+# shrinking and base64 encoding, so they run alongside each other without
+# blocking the gevent event loop
+native_executor = gevent.threadpool.ThreadPoolExecutor(max_workers=4)
+
+# Uploads are held in memory until their job has written and encoded them,
+# so cap how many can be in flight; further uploads wait for a free slot
+MAX_INFLIGHT_UPLOADS = 8
+UPLOAD_SLOT_TIMEOUT = 30  # seconds to wait for a slot before giving up
+upload_slots = threading.BoundedSemaphore(MAX_INFLIGHT_UPLOADS)
+
+# In-process LRU cache of analysis results keyed by image content hash,
+# so re-uploading the same photo skips the OpenAI round trip
+ANALYSIS_CACHE_SIZE = 1024
+analysis_cache = OrderedDict()
+analysis_cache_lock = threading.Lock()
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def encode_image_to_base64(image_path):
-    """Convert image to base64 string"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def has_image_signature(image_stream):
+    """Check the stream starts like a PNG, JPEG or GIF, then rewind it"""
+    head = image_stream.read(12)
+    image_stream.seek(0)
+    return head.startswith(IMAGE_SIGNATURES)
+
+# Longest side and JPEG quality for images sent to the vision model;
+# larger images only add payload size and image token cost
+ANALYSIS_MAX_SIZE = (1024, 1024)
+ANALYSIS_JPEG_QUALITY = 85
 
-def get_banana_back_feedback(base64_image, api_key, model_name):
+def shrink_image_for_analysis(image_stream):
     """
-    Get detailed feedback explaining why a handstand is classified as banana back
+    Downscale an image and re-encode it as JPEG in memory, returning a new stream.
+    Falls back to the original stream if the image cannot be decoded.
+    """
+    try:
+        with Image.open(image_stream) as img:
+            # Apply EXIF rotation before it is dropped by the re-encode
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(ANALYSIS_MAX_SIZE)
+            buffer = io.BytesIO()
+            img.convert("RGB").save(buffer, "JPEG", quality=ANALYSIS_JPEG_QUALITY, optimize=True)
+        buffer.seek(0)
+        return buffer
+    except Exception:
+        image_stream.seek(0)
+        return image_stream
+
+# Read size for streaming base64 encoding; a multiple of 3 so no padding
+# is emitted mid-stream and the chunks concatenate to the whole-file encoding
+BASE64_CHUNK_SIZE = 3 * 65536
+
+def encode_image_to_base64(image_stream):
+    """Convert an image stream to base64 string, encoding it in fixed-size chunks"""
+    encoded = bytearray()
+    while chunk := image_stream.read(BASE64_CHUNK_SIZE):
+        encoded += base64.b64encode(chunk)
+    return encoded.decode('ascii')
+
+def encode_image_for_analysis(image_data):
+    """Shrink image bytes for the vision model and return them as a base64 string"""
+    return encode_image_to_base64(shrink_image_for_analysis(io.BytesIO(image_data)))
+
+def sign_upload(filename, expires):
+    """HMAC signature for an uploaded filename and expiry timestamp"""
+    message = f"{filename}:{expires}".encode()
+    return hmac.new(URL_SIGNING_KEY, message, hashlib.sha256).hexdigest()
+
+def upload_url(filename):
+    """URL path for an uploaded file, signed when uploads are publicly exposed"""
+    if not PUBLIC_BASE_URL:
+        return url_for('uploaded_file', filename=filename)
+    # Expire at the end of the next TTL-aligned window rather than now + TTL, so
+    # the URL stays the same across views and browser caching still applies
+    expires = (int(time.time()) // UPLOAD_URL_TTL + 2) * UPLOAD_URL_TTL
+    return url_for('uploaded_file', filename=filename,
+                   expires=expires, signature=sign_upload(filename, expires))
+
+def get_banana_back_feedback(image_url, model_name):
+    """
+    Get detailed feedback explaining why a handstand is classified as banana back.
+    Returns None if the feedback could not be generated.
     """
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
         payload = {
             "model": model_name,
             "temperature": 0.3,
@@ -60,7 +221,7 @@ def get_banana_back_feedback(base64_image, api_key, model_name):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": image_url
                             }
                         }
                     ]
@@ -69,172 +230,172 @@ def get_banana_back_feedback(base64_image, api_key, model_name):
             "max_tokens": 200
         }
         
-        response = requests.post("https://api.openai.com/v1/chat/completions", 
-                               headers=headers, json=payload, timeout=30)
+        response = CLIENT.post("https://api.openai.com/v1/chat/completions", 
+                             headers=AUTH_HEADERS, content=orjson.dumps(payload), timeout=OPENAI_TIMEOUT)
         
         if response.status_code == 200:
             result = response.json()
             return result['choices'][0]['message']['content'].strip()
         else:
-            return "Unable to generate detailed feedback at this time."
+            return None
             
-    except Exception as e:
-        return f"Error generating feedback: {str(e)}"
+    except Exception:
+        return None
 
-def analyze_handstand_posture(image_path):
+def read_streamed_label(response):
     """
-    Analyze handstand posture using OpenAI's vision model
+    Accumulate streamed chat completion text until it contains a
+    classification label or the stream ends
     """
-    api_key = os.getenv('OPENAI_API_KEY')
-    
-    if not api_key:
-        return {
-            'analysis': 'Error: OpenAI API key not found. Please set OPENAI_API_KEY environment variable.',
-            'form_quality': 'error',
-            'detailed_feedback': None
-        }
-    
-    # Test API key works
-    try:
-        test_headers = {"Authorization": f"Bearer {api_key}"}
-        test_response = requests.get("https://api.openai.com/v1/models", headers=test_headers)
-        if test_response.status_code != 200:
-            return {
-                'analysis': f'API key validation failed: {test_response.status_code}',
-                'form_quality': 'error',
-                'detailed_feedback': None
-            }
-    except Exception as e:
-        return {
-            'analysis': f'API connection test failed: {str(e)}',
-            'form_quality': 'error',
-            'detailed_feedback': None
-        }
-    
-    try:
-        # Encode image to base64
-        base64_image = encode_image_to_base64(image_path)
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        # Try models that support vision
-        models_to_try = ["gpt-4o", "gpt-4-turbo", "gpt-4-turbo-2024-04-09"]
-        
-        for model_name in models_to_try:
-            payload = {
-                    "model": model_name,
-                    "temperature": 0,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": (
-                                "You are a strict vision classifier. "
-                                "Goal: From a SIDE-ON photo of a handstand, output exactly one label: "
-                                "\"good form\" or \"banana back\". "
-                                "Definitions: "
-                                "• banana back = clear lumbar/spinal arch; ribs flare forward; hips in front of shoulders; "
-                                "  legs/feet drift behind the body, making a C/banana shape. "
-                                "• good form = wrists–shoulders–hips–ankles vertically stacked; neutral spine; ribs tucked; "
-                                "  no visible midsection curve. "
-                                "Rules: Output ONLY one of these strings with no punctuation or explanation."
-                            )
-                        },
+    text = ""
+    for line in response.iter_lines():
+        if not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            break
+        chunk = json.loads(data)
+        if chunk['choices']:
+            text += chunk['choices'][0]['delta'].get('content') or ""
+        lowered = text.lower()
+        if "banana" in lowered or "good" in lowered:
+            break
+    return text
 
-                        # --- Few-shot text-only examples (no images needed) ---
-                        {
-                            "role": "user",
-                            "content": (
-                                "Side-on handstand description: hips are ahead of the shoulder line, "
-                                "lower back is arched, chest/ribs flaring, legs trailing behind."
-                            )
-                        },
-                        {"role": "assistant", "content": "banana back"},
+# Classifier system prompt and few-shot examples, built once at import;
+# each request only appends the message carrying the uploaded image
+CLASSIFY_BASE_MESSAGES = (
+    {
+        "role": "system",
+        "content": (
+            "You are a strict vision classifier. "
+            "Goal: From a SIDE-ON photo of a handstand, output exactly one label: "
+            "\"good form\" or \"banana back\". "
+            "Definitions: "
+            "• banana back = clear lumbar/spinal arch; ribs flare forward; hips in front of shoulders; "
+            "  legs/feet drift behind the body, making a C/banana shape. "
+            "• good form = wrists–shoulders–hips–ankles vertically stacked; neutral spine; ribs tucked; "
+            "  no visible midsection curve. "
+            "Rules: Output ONLY one of these strings with no punctuation or explanation."
+        )
+    },
+
+    # --- Few-shot text-only examples (no images needed) ---
+    {
+        "role": "user",
+        "content": (
+            "Side-on handstand description: hips are ahead of the shoulder line, "
+            "lower back is arched, chest/ribs flaring, legs trailing behind."
+        )
+    },
+    {"role": "assistant", "content": "banana back"},
 
+    {
+        "role": "user",
+        "content": (
+            "Side-on handstand description: wrists, shoulders, hips, ankles form one vertical line; "
+            "spine looks neutral; ribs tucked; toes stacked over hips."
+        )
+    },
+    {"role": "assistant", "content": "good form"},
+    # --- End few-shot ---
+)
+
+CLASSIFY_PAYLOAD_TEMPLATE = {
+    "model": VISION_MODEL,
+    "temperature": 0,
+    "max_tokens": 5,
+    "stream": True
+}
+
+def analyze_handstand_posture(image_url):
+    """
+    Analyze a handstand image using OpenAI's vision model.
+    image_url is either a base64 data URI or a publicly reachable URL.
+    """
+    try:
+        # Static system prompt and few-shot examples plus the uploaded image
+        payload = dict(
+            CLASSIFY_PAYLOAD_TEMPLATE,
+            messages=[
+                *CLASSIFY_BASE_MESSAGES,
+                {
+                    "role": "user",
+                    "content": [
                         {
-                            "role": "user",
-                            "content": (
-                                "Side-on handstand description: wrists, shoulders, hips, ankles form one vertical line; "
-                                "spine looks neutral; ribs tucked; toes stacked over hips."
+                            "type": "text",
+                            "text": (
+                                "Classify this SIDE-ON handstand image as exactly one label: "
+                                "\"good form\" or \"banana back\"."
                             )
                         },
-                        {"role": "assistant", "content": "good form"},
-                        # --- End few-shot ---
-
-                        # Now ask the model to classify the actual uploaded image
                         {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": (
-                                        "Classify this SIDE-ON handstand image as exactly one label: "
-                                        "\"good form\" or \"banana back\"."
-                                    )
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
-                                    }
-                                }
-                            ]
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url
+                            }
                         }
-                    ],
-                    "max_tokens": 5
+                    ]
                 }
-
-            
-            response = requests.post("https://api.openai.com/v1/chat/completions", 
-                                   headers=headers, json=payload, timeout=30)
-            
+            ]
+        )
+        
+        # Stream the completion and hang up as soon as the label is readable,
+        # so the connection is released before the stop token arrives
+        with CLIENT.stream("POST", "https://api.openai.com/v1/chat/completions",
+                           headers=AUTH_HEADERS, content=orjson.dumps(payload), timeout=OPENAI_TIMEOUT) as response:
             if response.status_code == 200:
-                result = response.json()
-                analysis_text = result['choices'][0]['message']['content'].strip().lower()
-                if "banana" in analysis_text:
-                    analysis_text = "banana back"
-                elif "good" in analysis_text:
-                    analysis_text = "good form"
-                else:
-                    analysis_text = analysis_text.splitlines()[0].strip()
+                streamed_text = read_streamed_label(response)
+        
+        if response.status_code == 200:
+            analysis_text = streamed_text.strip().lower()
+            if "banana" in analysis_text:
+                analysis_text = "banana back"
+            elif "good" in analysis_text:
+                analysis_text = "good form"
+            else:
+                analysis_text = analysis_text.splitlines()[0].strip()
+            
+            # Determine form quality based on response
+            if "good form" in analysis_text:
+                form_quality = "good"
+                return {
+                    'analysis': analysis_text,
+                    'form_quality': form_quality,
+                    'detailed_feedback': None
+                }
+            elif "banana back" in analysis_text:
+                form_quality = "bad"
                 
-                # Determine form quality based on response
-                if "good form" in analysis_text:
-                    form_quality = "good"
-                    return {
-                        'analysis': analysis_text,
-                        'form_quality': form_quality,
-                        'detailed_feedback': None
-                    }
-                elif "banana back" in analysis_text:
-                    form_quality = "bad"
-                    
-                    # Get detailed feedback for banana back
-                    detailed_feedback = get_banana_back_feedback(base64_image, api_key, model_name)
-                    
-                    return {
-                        'analysis': analysis_text,
-                        'form_quality': form_quality,
-                        'detailed_feedback': detailed_feedback
-                    }
-                else:
-                    form_quality = "unclear"
-                    return {
-                        'analysis': analysis_text,
-                        'form_quality': form_quality,
-                        'detailed_feedback': None
-                    }
-            # If this model fails, try the next one
-        # If we get here, all models failed
+                # Get detailed feedback for banana back
+                detailed_feedback = get_banana_back_feedback(image_url, VISION_MODEL)
+                
+                return {
+                    'analysis': analysis_text,
+                    'form_quality': form_quality,
+                    'detailed_feedback': detailed_feedback
+                }
+            else:
+                form_quality = "unclear"
+                return {
+                    'analysis': analysis_text,
+                    'form_quality': form_quality,
+                    'detailed_feedback': None
+                }
+        elif response.status_code in (401, 403):
+            return {
+                'analysis': f'API key validation failed: {response.status_code}',
+                'form_quality': 'error',
+                'detailed_feedback': None
+            }
+        
         return {
-            'analysis': 'All vision models failed. Please try again.',
+            'analysis': f'Vision model request failed: {response.status_code}. Please try again.',
             'form_quality': 'error',
             'detailed_feedback': None
         }
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return {
             'analysis': f'API request error: {str(e)}',
             'form_quality': 'error',
@@ -247,6 +408,128 @@ def analyze_handstand_posture(image_path):
             'detailed_feedback': None
         }
 
+def analyze_handstand_posture_cached(image_hash, image_url):
+    """
+    Return the cached analysis for an image hash, calling
+    analyze_handstand_posture on a miss. Errors and banana back results
+    whose detailed feedback failed are not cached, so they are retried.
+    """
+    with analysis_cache_lock:
+        if image_hash in analysis_cache:
+            analysis_cache.move_to_end(image_hash)
+            return analysis_cache[image_hash]
+    
+    analysis_result = analyze_handstand_posture(image_url)
+    
+    feedback_failed = analysis_result['form_quality'] == 'bad' and not analysis_result['detailed_feedback']
+    if analysis_result['form_quality'] != 'error' and not feedback_failed:
+        with analysis_cache_lock:
+            analysis_cache[image_hash] = analysis_result
+            if len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+                analysis_cache.popitem(last=False)
+    return analysis_result
+
+def evict_oldest_files(folder, max_files):
+    """Delete the least recently written files in a folder beyond max_files"""
+    entries = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            try:
+                if entry.is_file():
+                    entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    
+    entries.sort(reverse=True)
+    for _, path in entries[max_files:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already removed by a sweep in another worker process
+            pass
+
+def evict_old_files():
+    """Bound the uploads and jobs folders, skipping if a sweep is already running"""
+    if not eviction_lock.acquire(blocking=False):
+        return
+    try:
+        evict_oldest_files(app.config['UPLOAD_FOLDER'], MAX_UPLOADS)
+        evict_oldest_files(app.config['JOBS_FOLDER'], MAX_JOBS)
+    finally:
+        eviction_lock.release()
+
+def save_upload(filepath, image_data):
+    """
+    Write an upload to disk. Files are named by content hash, so an existing
+    file already holds these bytes and is only marked as recently used; it is
+    never rewritten in place while it may be being served.
+    """
+    try:
+        os.utime(filepath)
+        return
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+    Path(tmp_path).write_bytes(image_data)
+    os.replace(tmp_path, filepath)
+
+def save_job(job_id, job):
+    """Atomically write a job's state to the jobs folder"""
+    path = os.path.join(app.config['JOBS_FOLDER'], f"{job_id}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as job_file:
+        json.dump(job, job_file)
+    os.replace(tmp_path, path)
+
+def load_job(job_id):
+    """Read a job's state from the jobs folder, or None if it doesn't exist"""
+    path = os.path.join(app.config['JOBS_FOLDER'], f"{job_id}.json")
+    try:
+        with open(path) as job_file:
+            job = json.load(job_file)
+    except FileNotFoundError:
+        return None
+    
+    if job['status'] == 'pending' and time.time() - job.get('created', 0) > JOB_TIMEOUT:
+        return {
+            'status': 'error',
+            'filename': job['filename'],
+            'analysis': 'Analysis timed out. Please try again.',
+            'form_quality': 'error',
+            'detailed_feedback': None
+        }
+    return job
+
+def run_analysis_job(job_id, image_data, filename, image_hash, image_url=None):
+    """
+    Save and analyze an upload in the background and record the result.
+    image_url is the public URL to send instead of inline base64, if configured.
+    """
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    try:
+        try:
+            # Write the upload to disk while the image is shrunk and encoded
+            save_future = native_executor.submit(save_upload, filepath, image_data)
+            if not image_url:
+                base64_image = native_executor.submit(encode_image_for_analysis, image_data).result()
+                image_url = f"data:image/jpeg;base64,{base64_image}"
+            # The result page (and OpenAI, for public URLs) reads the file from disk
+            save_future.result()
+        finally:
+            # The raw upload bytes are no longer needed
+            upload_slots.release()
+        native_executor.submit(evict_old_files)
+        
+        analysis_result = analyze_handstand_posture_cached(image_hash, image_url)
+    except Exception as e:
+        analysis_result = {
+            'analysis': f'Error analyzing image: {str(e)}',
+            'form_quality': 'error',
+            'detailed_feedback': None
+        }
+    
+    save_job(job_id, {'status': 'done', 'filename': filename, **analysis_result})
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -261,33 +544,88 @@ def upload_file():
     if file.filename == '':
         return redirect(request.url)
     
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Analyze the handstand
-        analysis_result = analyze_handstand_posture(filepath)
+    # Reject files whose content isn't really an image before doing any work on them
+    if file and allowed_file(file.filename) and has_image_signature(file.stream):
+        if not upload_slots.acquire(timeout=UPLOAD_SLOT_TIMEOUT):
+            return render_template('result.html',
+                                 analysis='The server is busy. Please try again in a moment.',
+                                 form_quality='error',
+                                 detailed_feedback=None,
+                                 uploaded_image=None,
+                                 uploaded_image_url=None
+                                 ), 503
         
-        # Clean up uploaded file (optional)
-        # os.remove(filepath)
+        # The job releases the slot once it has written and encoded the upload;
+        # release it here if anything fails before the job is submitted
+        try:
+            # Buffer the upload once; the job writes it to disk while encoding it
+            image_data = file.read()
+            
+            # Name the file by its content hash so identical uploads share one file
+            # and each upload URL always serves the same bytes (cacheable indefinitely).
+            # Hash on a native thread so a large upload doesn't block the event loop
+            image_hash = native_executor.submit(hashlib.sha256, image_data).result().hexdigest()
+            extension = file.filename.rsplit('.', 1)[1].lower()
+            filename = f"{image_hash[:16]}.{extension}"
+            
+            # Analyze the handstand in the background; the pending page polls for the result.
+            # The signed URL is built here since url_for needs the request context
+            job_id = uuid.uuid4()
+            image_url = PUBLIC_BASE_URL + upload_url(filename) if PUBLIC_BASE_URL else None
+            save_job(job_id, {'status': 'pending', 'filename': filename, 'created': time.time()})
+            executor.submit(run_analysis_job, job_id, image_data, filename, image_hash, image_url)
+        except BaseException:
+            upload_slots.release()
+            raise
         
-        return render_template('result.html', 
-                             analysis=analysis_result['analysis'],
-                             form_quality=analysis_result['form_quality'],
-                             detailed_feedback=analysis_result.get('detailed_feedback'),
-                             uploaded_image=filename
-                             )
+        return render_template('pending.html', job_id=job_id)
     
     return redirect(url_for('index'))
 
+@app.route('/status/<uuid:job_id>')
+def job_status(job_id):
+    job = load_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(status=job['status'], result_url=url_for('job_result', job_id=job_id))
+
+@app.route('/result/<uuid:job_id>')
+def job_result(job_id):
+    job = load_job(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] == 'pending':
+        return render_template('pending.html', job_id=job_id)
+    
+    return render_template('result.html', 
+                         analysis=job['analysis'],
+                         form_quality=job['form_quality'],
+                         detailed_feedback=job.get('detailed_feedback'),
+                         uploaded_image=job['filename'],
+                         uploaded_image_url=upload_url(job['filename'])
+                         )
+
 # Add route to serve uploaded images
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if PUBLIC_BASE_URL:
+        expires = request.args.get('expires', type=int)
+        signature = request.args.get('signature', '')
+        if expires is None or expires < time.time() or \
+           not hmac.compare_digest(signature, sign_upload(filename, expires)):
+            abort(403)
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename,
+                                   max_age=UPLOAD_MAX_AGE, conditional=True)
+    response.cache_control.immutable = True
+    return response
 
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 1010))
     debug = os.environ.get('FLASK_ENV') == 'development'
-    app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
+    if debug:
+        app.run(host='0.0.0.0', port=port, debug=debug)
+    else:
+        # In production prefer: gunicorn -k gevent -w 2 app:app
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('0.0.0.0', port), app).serve_forever()
\ No newline at end of file